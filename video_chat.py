@@ -1,7 +1,15 @@
 import logging
-from flask import Flask, render_template_string, request
-from flask_socketio import SocketIO, emit, join_room, leave_room
+import os
+import re
+from collections import deque
+from flask import Flask, render_template_string, request, jsonify
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room, leave_room
+from socketio import packet as sio_packet
+from werkzeug.middleware.proxy_fix import ProxyFix
 import uuid
+import time
+from bisect import bisect_left
+from itertools import count
 
 # --- CONFIGURATION ---
 # Configure logging for production-grade output
@@ -12,6 +20,11 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 # cors_allowed_origins="*" is used for development convenience
 socketio = SocketIO(app, cors_allowed_origins="*")
+# Trust X-Forwarded-For only from our own proxy hops (Render adds one). Wrapped after SocketIO
+# so the Socket.IO handshake sees the corrected address too. Set TRUSTED_PROXIES=0 when serving directly.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 # --- GLOBAL STATE ---
 # In a production app, use Redis or a database.
@@ -20,6 +33,81 @@ active_pairs = {}   # Map socket_id -> partner_socket_id
 users = {}          # Map socket_id -> {'name': str, 'gender': str, 'interest': str}
 connected_users_count = 1000
 
+# Recent-partner exclusion: avoid re-matching users who just skipped each other.
+RECENT_PARTNER_TTL = 60     # Seconds a finished pair stays excluded from rematching
+RECENT_PARTNER_LIMIT = 10   # Max remembered partners per socket_id (oldest evicted first)
+recent_partners = {}        # Map socket_id -> {partner_socket_id: expiry_timestamp}
+pending_retries = set()     # Socket_ids with a scheduled rematch attempt
+
+# Admission control: past these limits new clients are told to retry later.
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 2000))
+MAX_QUEUE_LENGTH = int(os.environ.get('MAX_QUEUE_LENGTH', 500))
+READY_THRESHOLD = float(os.environ.get('READY_THRESHOLD', 0.9))  # Fraction of a limit at which /ready reports 503
+MATCH_RATE_WINDOW = 60      # Seconds of match history used to estimate queue wait
+RETRY_AFTER_MIN = 2         # Bounds for the "retry in N s" hint sent to busy clients
+RETRY_AFTER_MAX = 60
+active_connections = 0      # Real socket count (connected_users_count is the displayed figure)
+recent_matches = deque(maxlen=1000)  # Timestamps of recent matches
+
+# Client-side startup timings, reported by the browser in milliseconds.
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', 640))    # Ideal local camera resolution
+PREVIEW_HEIGHT = int(os.environ.get('PREVIEW_HEIGHT', 480))
+CLIENT_TIMING_MARKS = ('time_to_queue', 'time_to_local_frame', 'time_to_first_frame')
+TIMING_SAMPLES = 500        # Most recent samples kept per mark
+client_timings = {name: deque(maxlen=TIMING_SAMPLES) for name in CLIENT_TIMING_MARKS}
+TIMING_MIN_INTERVAL = 5     # Seconds between accepted reports of the same mark from one sid
+last_timing_reports = {}    # Map socket_id -> {mark: timestamp}
+
+# Call quality, from downsampled client getStats() reports. Fixed buckets keep memory constant.
+RTT_BUCKETS_MS = (25, 50, 100, 200, 400, 800)       # Upper bounds; the last count is overflow
+LOSS_BUCKETS_PCT = (0.5, 1, 2, 5, 10)
+BITRATE_BUCKETS_KBPS = (100, 300, 600, 1200, 2500)
+CONNECTION_TYPES = ('host', 'srflx', 'prflx', 'relay')
+CALL_STATS_MIN_INTERVAL = 8     # Seconds; clients report every 10 s, anything faster is dropped
+pair_call_stats = {}        # Map pair key -> call stats for the pair's lifetime
+last_call_stats = {}        # Map socket_id -> timestamp of last accepted report
+
+def new_histogram(bounds):
+    return {'bounds': bounds, 'counts': [0] * (len(bounds) + 1)}
+
+def new_call_stats():
+    return {
+        'rtt_ms': new_histogram(RTT_BUCKETS_MS),
+        'loss_pct': new_histogram(LOSS_BUCKETS_PCT),
+        'kbps': new_histogram(BITRATE_BUCKETS_KBPS),
+        'connection_type': dict.fromkeys(CONNECTION_TYPES, 0),
+    }
+
+global_call_stats = new_call_stats()
+call_stats_by_connection = {conn_type: new_call_stats() for conn_type in CONNECTION_TYPES}
+# One count per finished pair, bucketed by that pair's own summary
+pair_outcomes = {
+    'median_rtt_ms': new_histogram(RTT_BUCKETS_MS),
+    'worst_loss_pct': new_histogram(LOSS_BUCKETS_PCT),
+    'median_kbps': new_histogram(BITRATE_BUCKETS_KBPS),
+    'relayed': 0,
+}
+
+# Moderation runs after delivery on a worker pool; offending messages are retracted.
+MODERATION_WORKERS = int(os.environ.get('MODERATION_WORKERS', 2))
+MODERATION_QUEUE_SIZE = 1000    # Messages beyond this backlog are delivered unchecked
+MAX_MESSAGE_LENGTH = int(os.environ.get('MAX_MESSAGE_LENGTH', 500))
+BLOCKED_WORDS = [w.strip().lower() for w in os.environ.get('BLOCKED_WORDS', '').split(',') if w.strip()]
+BLOCKED_PATTERNS = [p for p in os.environ.get('BLOCKED_PATTERNS', '').split('\n') if p.strip()]
+MUTE_REPORT_THRESHOLD = 3   # Distinct reporters needed to mute a user
+REPORT_TTL = 3600           # Seconds a report counts towards a mute
+MUTE_TTL = 3600             # Seconds a mute lasts
+moderation_filters = []     # Callables (sid, msg) -> reason string, or None if the message is fine
+# The server's queue type matches its async mode, so workers yield instead of blocking the hub
+moderation_queue = socketio.server.eio.create_queue(maxsize=MODERATION_QUEUE_SIZE)
+moderation_started = False
+message_ids = count(1)
+# Reports and mutes are keyed by client address so a page reload does not clear them.
+# Users sharing an address (NAT, campus networks) share a mute.
+client_keys = {}            # Map socket_id -> client address
+user_reports = {}           # Map client address -> {reporter address: expiry_timestamp}
+muted_clients = {}          # Map client address -> mute expiry_timestamp
+
 # --- FRONTEND TEMPLATE (HTML/CSS/JS) ---
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -203,6 +291,9 @@ HTML_TEMPLATE = """
                 <div id="partnerInfoTag" class="absolute top-4 left-4 glass px-4 py-2 rounded-lg hidden flex items-center gap-2">
                     <div class="w-2 h-2 bg-red-500 rounded-full animate-pulse"></div>
                     <span id="partnerNameDisplay" class="font-medium text-sm">Stranger</span>
+                    <button id="reportBtn" class="ml-2 text-slate-400 hover:text-rose-400 transition-colors" title="Report">
+                        <i class="fas fa-flag text-xs"></i>
+                    </button>
                 </div>
             </div>
 
@@ -276,6 +367,8 @@ HTML_TEMPLATE = """
     <script>
         const socket = io();
         const STORAGE_KEY = 'chat_user_profile_v2';
+        const PREVIEW = {{ preview | tojson }};
+        const STATS_INTERVAL = 10000; // ms between call quality reports
 
         // DOM Elements
         const localVideo = document.getElementById('localVideo');
@@ -294,6 +387,7 @@ HTML_TEMPLATE = """
         const toggleMicBtn = document.getElementById('toggleMicBtn');
         const toggleCamBtn = document.getElementById('toggleCamBtn');
         const partnerInfoTag = document.getElementById('partnerInfoTag');
+        const reportBtn = document.getElementById('reportBtn');
         const partnerNameDisplay = document.getElementById('partnerNameDisplay');
         const greetingOverlay = document.getElementById('greetingOverlay');
         const greetingName = document.getElementById('greetingName');
@@ -354,6 +448,11 @@ HTML_TEMPLATE = """
         };
 
         let localStream;
+        let mediaPromise = null;
+        let matchedAt = 0;
+        let loginAt = 0;
+        let statsTimer = null;
+        let lastInbound = null;
         let peerConnection;
         let partnerId = null;
         let partnerName = "Stranger";
@@ -373,7 +472,30 @@ HTML_TEMPLATE = """
             return stored ? JSON.parse(stored) : null;
         }
 
+        // Startup timing marks, reported to the server for aggregation
+        const reportedMarks = new Set();
+        function reportTiming(name, ms, once = true) {
+            if (once && reportedMarks.has(name)) return;
+            reportedMarks.add(name);
+            performance.mark(name);
+            socket.emit('client_timing', { name: name, ms: Math.round(ms) });
+        }
+
+        localVideo.addEventListener('loadeddata', () => {
+            if (loginAt) reportTiming('time_to_local_frame', performance.now() - loginAt);
+        });
+        remoteVideo.addEventListener('loadeddata', () => {
+            if (matchedAt) reportTiming('time_to_first_frame', performance.now() - matchedAt, false);
+            matchedAt = 0;
+        });
+
         function processLogin(profile) {
+            const firstLogin = !myName;
+            // Startup timings count from login, not page load, so form-filling time is excluded
+            if (firstLogin) {
+                loginAt = performance.now();
+                performance.mark('login');
+            }
             myName = profile.name;
             myData = profile;
             saveProfile(profile);
@@ -388,7 +510,9 @@ HTML_TEMPLATE = """
             if (socket.connected) {
                 socket.emit('join_user', myData);
             }
-            startCamera();
+            // Queue straight away; the camera is acquired in parallel and attached when a match arrives
+            if (!mediaPromise) mediaPromise = startCamera();
+            if (firstLogin && !partnerId) findNewPartner();
         }
 
         // Auto-login
@@ -426,7 +550,10 @@ HTML_TEMPLATE = """
         async function startCamera() {
             try {
                 if (!localStream) {
-                    localStream = await navigator.mediaDevices.getUserMedia({ video: { width: 640 }, audio: true });
+                    localStream = await navigator.mediaDevices.getUserMedia({
+                        video: { width: { ideal: PREVIEW.width }, height: { ideal: PREVIEW.height } },
+                        audio: true
+                    });
                     localVideo.srcObject = localStream;
                 }
             } catch (err) {
@@ -457,6 +584,8 @@ HTML_TEMPLATE = """
             statusEl.innerText = "Connected";
             statusEl.classList.add('text-emerald-500');
             if (myName) socket.emit('join_user', myData);
+            // Anything queued before the profile reached the server was dropped, so ask again
+            if (myName && isSearching && !partnerId) socket.emit('find_partner');
         });
 
         socket.on('disconnect', () => {
@@ -465,14 +594,40 @@ HTML_TEMPLATE = """
             statusEl.classList.add('text-amber-500');
         });
 
+        socket.on('connect_error', (err) => {
+            // Server rejected the connection because it is at capacity
+            // Refused connections are not retried by the client, so schedule it ourselves
+            if (err.message !== 'server_busy' || !err.data) return;
+            statusEl.innerText = `Server busy, retrying in ${err.data.retry_after}s`;
+            statusEl.classList.add('text-amber-500');
+            setTimeout(() => socket.connect(), err.data.retry_after * 1000);
+        });
+
+        socket.on('server_busy', (data) => {
+            addSystemMessage(`Server busy, retrying in ${data.retry_after}s...`, 'error');
+            setTimeout(() => {
+                if (isSearching && !partnerId) socket.emit('find_partner');
+            }, data.retry_after * 1000);
+        });
+
         socket.on('user_count', (count) => {
             userCountEl.innerText = `${count} online`;
         });
 
+        // time_to_queue ends when the server confirms the user is queued (or matched)
+        function reportQueued() {
+            if (loginAt) reportTiming('time_to_queue', performance.now() - loginAt);
+        }
+
+        socket.on('queued', reportQueued);
+
         socket.on('match_found', (data) => {
             partnerId = data.partner_id;
             partnerName = data.partner_name || "Stranger";
             isSearching = false;
+            matchedAt = performance.now();
+            // An immediate match means the user never waited in the queue
+            reportQueued();
             
             playNotification('match'); // Sound Effect
 
@@ -522,10 +677,23 @@ HTML_TEMPLATE = """
 
         socket.on('receive_message', (data) => {
             playNotification('message'); // Sound Effect
-            addChatMessage(partnerName, data.msg, false);
+            const message = addChatMessage(partnerName, data.msg, false);
+            message.dataset.msgId = data.id;
             typingIndicator.classList.add('hidden');
         });
 
+        socket.on('message_retracted', (data) => {
+            const message = chatLog.querySelector(`[data-msg-id="${data.id}"]`);
+            if (!message) return;
+            const bubble = message.firstChild;
+            bubble.textContent = "Message removed";
+            bubble.classList.add('italic', 'opacity-50');
+        });
+
+        socket.on('message_blocked', () => {
+            addSystemMessage("Your message was removed by moderation.", 'error');
+        });
+
         socket.on('partner_typing', (data) => {
             typingNameEl.innerText = partnerName;
             data.isTyping ? typingIndicator.classList.remove('hidden') : typingIndicator.classList.add('hidden');
@@ -535,9 +703,12 @@ HTML_TEMPLATE = """
             if (!peerConnection) return;
             try {
                 if (data.type === 'offer') {
-                    await peerConnection.setRemoteDescription(new RTCSessionDescription(data.sdp));
-                    const answer = await peerConnection.createAnswer();
-                    await peerConnection.setLocalDescription(answer);
+                    const pc = peerConnection;
+                    await pc.setRemoteDescription(new RTCSessionDescription(data.sdp));
+                    await attachLocalMedia(pc);
+                    if (pc !== peerConnection) return;
+                    const answer = await pc.createAnswer();
+                    await pc.setLocalDescription(answer);
                     socket.emit('signal', { target: partnerId, type: 'answer', sdp: answer });
                 } else if (data.type === 'answer') {
                     await peerConnection.setRemoteDescription(new RTCSessionDescription(data.sdp));
@@ -548,9 +719,16 @@ HTML_TEMPLATE = """
         });
 
         // --- 3. WebRTC ---
+        // Waits for the camera (if still pending) and adds its tracks once per connection
+        async function attachLocalMedia(pc) {
+            await mediaPromise;
+            if (pc !== peerConnection || pc.getSenders().some(sender => sender.track)) return;
+            if (localStream) localStream.getTracks().forEach(track => pc.addTrack(track, localStream));
+        }
+
         function startWebRTC(isOfferer) {
             peerConnection = new RTCPeerConnection(peerConnectionConfig);
-            if (localStream) localStream.getTracks().forEach(track => peerConnection.addTrack(track, localStream));
+            const pc = peerConnection;
 
             peerConnection.ontrack = (event) => {
                 remoteVideo.srcObject = event.streams[0];
@@ -560,18 +738,67 @@ HTML_TEMPLATE = """
                 if (event.candidate) socket.emit('signal', { target: partnerId, type: 'candidate', candidate: event.candidate });
             };
 
+            lastInbound = null;
+            clearInterval(statsTimer);
+            statsTimer = setInterval(() => reportCallStats(pc).catch(() => {}), STATS_INTERVAL);
+
             if (isOfferer) {
-                peerConnection.onnegotiationneeded = async () => {
-                    try {
-                        const offer = await peerConnection.createOffer();
-                        await peerConnection.setLocalDescription(offer);
-                        socket.emit('signal', { target: partnerId, type: 'offer', sdp: offer });
-                    } catch (err) { console.error(err); }
-                };
+                // Tracks go in before the offer so the SDP already carries our media
+                attachLocalMedia(pc).then(async () => {
+                    if (pc !== peerConnection) return;
+                    if (!localStream) {
+                        pc.addTransceiver('audio', { direction: 'recvonly' });
+                        pc.addTransceiver('video', { direction: 'recvonly' });
+                    }
+                    const offer = await pc.createOffer();
+                    await pc.setLocalDescription(offer);
+                    socket.emit('signal', { target: partnerId, type: 'offer', sdp: offer });
+                }).catch(err => console.error(err));
+            }
+        }
+
+        // Sends a small summary of getStats() so the server can track call quality
+        async function reportCallStats(pc) {
+            if (pc !== peerConnection || pc.connectionState !== 'connected') return;
+            const report = await pc.getStats();
+            let selectedPair = null;
+            const inbound = { bytes: 0, received: 0, lost: 0, at: performance.now() };
+            report.forEach(stat => {
+                if (stat.type === 'transport' && stat.selectedCandidatePairId) {
+                    selectedPair = report.get(stat.selectedCandidatePairId);
+                } else if (stat.type === 'inbound-rtp') {
+                    inbound.bytes += stat.bytesReceived || 0;
+                    inbound.received += stat.packetsReceived || 0;
+                    inbound.lost += stat.packetsLost || 0;
+                }
+            });
+            if (!selectedPair) {
+                report.forEach(stat => {
+                    if (stat.type === 'candidate-pair' && stat.nominated && stat.state === 'succeeded') selectedPair = stat;
+                });
+            }
+
+            const sample = {};
+            if (selectedPair) {
+                if (selectedPair.currentRoundTripTime !== undefined) sample.rtt_ms = selectedPair.currentRoundTripTime * 1000;
+                const local = report.get(selectedPair.localCandidateId);
+                const remote = report.get(selectedPair.remoteCandidateId);
+                const relayed = [local, remote].some(c => c && c.candidateType === 'relay');
+                if (local) sample.connection_type = relayed ? 'relay' : local.candidateType;
+            }
+            if (lastInbound) {
+                const packets = (inbound.received - lastInbound.received) + (inbound.lost - lastInbound.lost);
+                if (packets > 0) sample.loss_pct = Math.max(0, inbound.lost - lastInbound.lost) / packets * 100;
+                // Bits per millisecond is kbps
+                sample.kbps = (inbound.bytes - lastInbound.bytes) * 8 / (inbound.at - lastInbound.at);
             }
+            lastInbound = inbound;
+            socket.emit('call_stats', sample);
         }
 
         function closeConnection() {
+            clearInterval(statsTimer);
+            statsTimer = null;
             if (peerConnection) {
                 peerConnection.close();
                 peerConnection = null;
@@ -586,8 +813,9 @@ HTML_TEMPLATE = """
         // --- 4. INTERACTIONS ---
         function findNewPartner() {
             if (isSearching) return;
+            const requeue = !!partnerId;
             if (partnerId) {
-                socket.emit('leave_chat'); 
+                socket.emit('leave_chat', { requeue: true }); 
                 closeConnection();
             }
             isSearching = true;
@@ -599,7 +827,7 @@ HTML_TEMPLATE = """
             chatLog.innerHTML = '';
             
             addSystemMessage("Searching for a partner...");
-            socket.emit('find_partner');
+            if (!requeue) socket.emit('find_partner');
         }
 
         nextBtn.addEventListener('click', findNewPartner);
@@ -614,6 +842,14 @@ HTML_TEMPLATE = """
             socket.emit('leave_queue');
         });
 
+        reportBtn.addEventListener('click', () => {
+            if (!partnerId) return;
+            const reportedName = partnerName;
+            socket.emit('report_partner');
+            findNewPartner();
+            addSystemMessage(`You reported ${reportedName}.`, 'error');
+        });
+
         chatForm.addEventListener('submit', (e) => {
             e.preventDefault();
             const msg = msgInput.value.trim();
@@ -637,7 +873,10 @@ HTML_TEMPLATE = """
             const div = document.createElement('div');
             const color = type === 'error' ? 'text-rose-400' : 'text-slate-500';
             div.className = `text-center text-xs font-medium my-3 ${color} uppercase tracking-wider`;
-            div.innerHTML = `<span>— ${text} —</span>`;
+            // SECURITY FIX: Messages can include partner-chosen names, so use textContent instead of innerHTML
+            const span = document.createElement('span');
+            span.textContent = `— ${text} —`;
+            div.appendChild(span);
             chatLog.appendChild(div);
             scrollToBottom();
         }
@@ -658,6 +897,7 @@ HTML_TEMPLATE = """
             wrapper.appendChild(bubble);
             chatLog.appendChild(wrapper);
             scrollToBottom();
+            return wrapper;
         }
 
         function scrollToBottom() { chatLog.scrollTop = chatLog.scrollHeight; }
@@ -674,20 +914,92 @@ HTML_TEMPLATE = """
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, preview={'width': PREVIEW_WIDTH, 'height': PREVIEW_HEIGHT})
+
+@app.route('/health')
+def health():
+    # Liveness only: always 200 while the process is serving, even under load
+    return 'ok'
+
+@app.route('/ready')
+def ready():
+    # Lets the load balancer shift traffic away before the worker saturates
+    is_ready = (active_connections < MAX_CONNECTIONS * READY_THRESHOLD and
+                len(waiting_users) < MAX_QUEUE_LENGTH * READY_THRESHOLD)
+    body = {
+        'ready': is_ready,
+        'connections': active_connections,
+        'max_connections': MAX_CONNECTIONS,
+        'queue_length': len(waiting_users),
+        'max_queue_length': MAX_QUEUE_LENGTH,
+    }
+    return jsonify(body), 200 if is_ready else 503
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        'connections': active_connections,
+        'queue_length': len(waiting_users),
+        'active_pairs': len(active_pairs) // 2,
+        'match_rate': get_match_rate(),
+        'client_timings': {name: summarize(samples) for name, samples in client_timings.items()},
+        'call_stats': global_call_stats,
+        'call_stats_by_connection': call_stats_by_connection,
+        # Per-pair stats stay server-side; only bounded counts are public
+        'pairs_reporting': len(pair_call_stats),
+        'pair_outcomes': pair_outcomes,
+    })
+
+# --- ADMISSION CONTROL ---
+
+def get_match_rate():
+    """Matches per second over the last MATCH_RATE_WINDOW seconds."""
+    cutoff = time.monotonic() - MATCH_RATE_WINDOW
+    while recent_matches and recent_matches[0] < cutoff:
+        recent_matches.popleft()
+    return len(recent_matches) / MATCH_RATE_WINDOW
+
+def estimate_retry_after():
+    rate = get_match_rate()
+    if not rate: return RETRY_AFTER_MAX
+    # Each match takes one user off the queue
+    wait = len(waiting_users) / rate
+    return int(min(max(wait, RETRY_AFTER_MIN), RETRY_AFTER_MAX))
+
+def busy_payload(reason):
+    return {'reason': reason, 'retry_after': estimate_retry_after()}
+
+# --- CLIENT METRICS ---
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered: return {'count': 0}
+    last = len(ordered) - 1
+    return {
+        'count': len(ordered),
+        'p50': ordered[last // 2],
+        'p95': ordered[int(last * 0.95)],
+        'max': ordered[last],
+    }
 
 # --- SOCKET LOGIC ---
 
 @socketio.on('connect')
 def handle_connect():
-    global connected_users_count
+    global connected_users_count, active_connections
+    if active_connections >= MAX_CONNECTIONS:
+        logger.warning(f"Rejected connection {request.sid}: {active_connections} active")
+        raise ConnectionRefusedError('server_busy', busy_payload('connections'))
+    active_connections += 1
     connected_users_count += 1
+    client_keys[request.sid] = get_client_key()
     logger.info(f"User connected: {request.sid}. Total: {connected_users_count}")
     emit('user_count', connected_users_count, broadcast=True)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    global connected_users_count
+    global connected_users_count, active_connections
+    active_connections -= 1
     connected_users_count -= 1
     sid = request.sid
     logger.info(f"User disconnected: {sid}")
@@ -695,12 +1007,13 @@ def handle_disconnect():
     if sid in users: del users[sid]
     if sid in waiting_users: waiting_users.remove(sid)
     
-    if sid in active_pairs:
-        partner_id = active_pairs[sid]
+    partner_id = end_pair(sid)
+    if partner_id:
         emit('partner_disconnected', room=partner_id)
-        del active_pairs[sid]
-        if partner_id in active_pairs:
-            del active_pairs[partner_id]
+    recent_partners.pop(sid, None)
+    client_keys.pop(sid, None)
+    last_call_stats.pop(sid, None)
+    last_timing_reports.pop(sid, None)
             
     emit('user_count', connected_users_count, broadcast=True)
 
@@ -717,69 +1030,378 @@ def check_match(user_a, user_b):
     b_wants_a = (user_b['interest'] in ['any', 'both']) or (user_b['interest'] == user_a['gender'])
     return a_wants_b and b_wants_a
 
-@socketio.on('find_partner')
-def find_partner():
-    sid = request.sid
+# --- RECENT PARTNERS ---
+
+def remember_partner(sid, partner_id):
+    now = time.monotonic()
+    recent = recent_partners.setdefault(sid, {})
+    recent.pop(partner_id, None)
+    recent[partner_id] = now + RECENT_PARTNER_TTL
+    # Dicts keep insertion order, so the first key is always the oldest entry
+    while len(recent) > RECENT_PARTNER_LIMIT:
+        del recent[next(iter(recent))]
+
+def get_recent_expiry(sid, partner_id):
+    """Returns the exclusion expiry for the pair, or 0 if they may be matched."""
+    recent = recent_partners.get(sid)
+    if not recent: return 0
+    now = time.monotonic()
+    for other in [p for p, expiry in recent.items() if expiry <= now]:
+        del recent[other]
+    if not recent:
+        del recent_partners[sid]
+        return 0
+    return recent.get(partner_id, 0)
+
+def end_pair(sid):
+    partner_id = active_pairs.pop(sid, None)
+    if partner_id is None: return None
+    active_pairs.pop(partner_id, None)
+    pair_stats = pair_call_stats.pop(get_pair_key(sid, partner_id), None)
+    if pair_stats: record_pair_outcome(pair_stats)
+    remember_partner(sid, partner_id)
+    remember_partner(partner_id, sid)
+    return partner_id
+
+# --- MATCHMAKING ---
+
+def find_waiting_partner(sid, current_user):
+    """Scans the queue in FIFO order. Returns (partner_id, retry_at); retry_at is the
+    earliest time an excluded recent partner becomes matchable, or 0."""
+    retry_at = 0
+    for waiter_sid in waiting_users:
+        if waiter_sid == sid: continue
+        waiter = users.get(waiter_sid)
+        if not (waiter and check_match(current_user, waiter)): continue
+        expiry = max(get_recent_expiry(sid, waiter_sid), get_recent_expiry(waiter_sid, sid))
+        if expiry:
+            retry_at = expiry if not retry_at else min(retry_at, expiry)
+            continue
+        return waiter_sid, retry_at
+    return None, retry_at
+
+def pair_users(sid, partner_id):
+    if sid in waiting_users: waiting_users.remove(sid)
+    waiting_users.remove(partner_id)
+    active_pairs[sid] = partner_id
+    active_pairs[partner_id] = sid
+    recent_matches.append(time.monotonic())
+    
+    current_user = users.get(sid)
+    partner_user = users.get(partner_id)
+    
+    socketio.emit('match_found', {'partner_id': partner_id, 'partner_name': partner_user['name'], 'role': 'offerer'}, room=sid)
+    socketio.emit('match_found', {'partner_id': sid, 'partner_name': current_user['name'], 'role': 'answerer'}, room=partner_id)
+    logger.info(f"Matched {sid} with {partner_id}")
+
+def match_or_enqueue(sid):
     if sid in active_pairs or sid in waiting_users: return
 
     current_user = users.get(sid)
     if not current_user: return
 
-    partner_id = None
-    match_index = -1
-    
-    for i, waiter_sid in enumerate(waiting_users):
-        waiter = users.get(waiter_sid)
-        if waiter and check_match(current_user, waiter):
-            match_index = i
-            partner_id = waiter_sid
-            break
+    partner_id, retry_at = find_waiting_partner(sid, current_user)
             
     if partner_id:
-        waiting_users.pop(match_index)
-        active_pairs[sid] = partner_id
-        active_pairs[partner_id] = sid
-        
-        partner_user = users.get(partner_id)
-        
-        emit('match_found', {'partner_id': partner_id, 'partner_name': partner_user['name'], 'role': 'offerer'}, room=sid)
-        emit('match_found', {'partner_id': sid, 'partner_name': current_user['name'], 'role': 'answerer'}, room=partner_id)
-        logger.info(f"Matched {sid} with {partner_id}")
+        pair_users(sid, partner_id)
+    elif len(waiting_users) >= MAX_QUEUE_LENGTH:
+        socketio.emit('server_busy', busy_payload('queue'), room=sid)
+        logger.warning(f"Queue full, rejected {sid}")
     else:
         waiting_users.append(sid)
         logger.info(f"User {sid} added to queue")
+        socketio.emit('queued', room=sid)
+        if retry_at and sid not in pending_retries:
+            # Only recent partners were compatible: try again once the exclusion expires
+            pending_retries.add(sid)
+            socketio.start_background_task(retry_match, sid, retry_at)
+
+def retry_match(sid, retry_at):
+    # Re-scans in place so the user keeps their queue position
+    try:
+        while retry_at:
+            socketio.sleep(max(retry_at - time.monotonic(), 0))
+            current_user = users.get(sid)
+            if sid not in waiting_users or not current_user: return
+            partner_id, retry_at = find_waiting_partner(sid, current_user)
+            if partner_id:
+                pair_users(sid, partner_id)
+                return
+    finally:
+        pending_retries.discard(sid)
+
+@socketio.on('find_partner')
+def find_partner():
+    match_or_enqueue(request.sid)
 
 @socketio.on('leave_chat')
-def leave_chat():
+def leave_chat(data=None):
     sid = request.sid
-    if sid in active_pairs:
-        partner_id = active_pairs[sid]
+    partner_id = end_pair(sid)
+    if partner_id:
         emit('partner_disconnected', room=partner_id)
-        del active_pairs[sid]
-        if partner_id in active_pairs:
-            del active_pairs[partner_id]
+    # Fast path for "Next": requeue in the same round trip instead of a separate find_partner
+    if data and data.get('requeue'):
+        match_or_enqueue(sid)
 
 @socketio.on('leave_queue')
 def leave_queue():
     sid = request.sid
     if sid in waiting_users: waiting_users.remove(sid)
 
+# --- RELAY ---
+
+def get_relay_target(data):
+    """Returns the caller's partner if the relay is addressed to them, else None."""
+    target = active_pairs.get(request.sid)
+    if target and data.get('target') == target: return target
+    return None
+
+def relay(event, data, target):
+    # Fast path: encode once and write straight to the partner's Engine.IO socket,
+    # skipping the request-bound emit and the room manager lookup.
+    server = socketio.server
+    eio_sid = server.manager.eio_sid_from_sid(target, '/')
+    if eio_sid is None: return
+    # packet_class honours the server's serializer (e.g. msgpack)
+    encoded = server.packet_class(sio_packet.EVENT, namespace='/', data=[event, data]).encode()
+    if isinstance(encoded, list):
+        # Binary attachments are sent as separate Engine.IO messages
+        for part in encoded: server.eio.send(eio_sid, part)
+    else:
+        server.eio.send(eio_sid, encoded)
+
 @socketio.on('signal')
 def handle_signal(data):
-    target = data.get('target')
-    if target: emit('signal', data, room=target)
+    target = get_relay_target(data)
+    if not target: return
+    # The partner only needs the SDP/candidate fields, not our routing info
+    relay('signal', {k: v for k, v in data.items() if k != 'target'}, target)
 
 @socketio.on('send_message')
 def handle_message(data):
-    target = data.get('target')
+    target = get_relay_target(data)
     msg = data.get('msg')
-    if target and msg: emit('receive_message', {'msg': msg}, room=target)
+    if not (target and msg): return
+    # A mute is a single dict lookup, so drop those inline rather than retracting later
+    if is_muted(request.sid):
+        emit('message_blocked', {'reason': 'muted'})
+        return
+    # Deliver first; moderation catches up and retracts if needed
+    msg_id = next(message_ids)
+    relay('receive_message', {'msg': msg, 'id': msg_id}, target)
+    submit_for_moderation(request.sid, target, msg_id, msg)
+
+@socketio.on('report_partner')
+def handle_report_partner():
+    sid = request.sid
+    partner_id = active_pairs.get(sid)
+    if not partner_id or is_muted(partner_id): return
+    reporter_key = client_keys.get(sid)
+    partner_key = client_keys.get(partner_id)
+    # Reports from the reported user's own address would let one person mute themselves out
+    if not reporter_key or not partner_key or reporter_key == partner_key: return
+    now = time.monotonic()
+    prune_reports(now)
+    reporters = user_reports.setdefault(partner_key, {})
+    reporters[reporter_key] = now + REPORT_TTL
+    if len(reporters) >= MUTE_REPORT_THRESHOLD:
+        muted_clients[partner_key] = now + MUTE_TTL
+        del user_reports[partner_key]
+        logger.info(f"Muted {partner_id} after {MUTE_REPORT_THRESHOLD} reports")
 
 @socketio.on('typing')
 def handle_typing(data):
-    target = data.get('target')
+    target = get_relay_target(data)
     is_typing = data.get('isTyping')
-    if target: emit('partner_typing', {'isTyping': is_typing}, room=target)
+    if target: relay('partner_typing', {'isTyping': is_typing}, target)
+
+def get_pair_key(sid, partner_id):
+    return tuple(sorted((sid, partner_id)))
+
+def record_call_stats(stats, sample):
+    for field in ('rtt_ms', 'loss_pct', 'kbps'):
+        value = sample.get(field)
+        if value is None: continue
+        hist = stats[field]
+        hist['counts'][bisect_left(hist['bounds'], value)] += 1
+    conn_type = sample.get('connection_type')
+    if conn_type: stats['connection_type'][conn_type] += 1
+
+def parse_call_stats(data):
+    """Keeps only well-formed fields from a client report."""
+    sample = {}
+    for field in ('rtt_ms', 'loss_pct', 'kbps'):
+        value = data.get(field)
+        if isinstance(value, (int, float)) and value >= 0: sample[field] = value
+    if data.get('connection_type') in CONNECTION_TYPES:
+        sample['connection_type'] = data['connection_type']
+    return sample
+
+def median_bucket(counts):
+    half = (sum(counts) + 1) // 2
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= half: return i
+
+def record_pair_outcome(stats):
+    """Folds a finished pair's histograms into the fixed per-pair outcome histograms."""
+    rtt_counts = stats['rtt_ms']['counts']
+    if any(rtt_counts): pair_outcomes['median_rtt_ms']['counts'][median_bucket(rtt_counts)] += 1
+    loss_counts = stats['loss_pct']['counts']
+    if any(loss_counts):
+        worst = max(i for i, n in enumerate(loss_counts) if n)
+        pair_outcomes['worst_loss_pct']['counts'][worst] += 1
+    kbps_counts = stats['kbps']['counts']
+    if any(kbps_counts): pair_outcomes['median_kbps']['counts'][median_bucket(kbps_counts)] += 1
+    if stats['connection_type']['relay']: pair_outcomes['relayed'] += 1
+
+@socketio.on('call_stats')
+def handle_call_stats(data):
+    sid = request.sid
+    partner_id = active_pairs.get(sid)
+    if not partner_id: return
+    sample = parse_call_stats(data)
+    if not sample: return
+    # Keep reports periodic so one socket cannot flood the shared histograms
+    now = time.monotonic()
+    if now - last_call_stats.get(sid, 0) < CALL_STATS_MIN_INTERVAL: return
+    last_call_stats[sid] = now
+    pair_stats = pair_call_stats.setdefault(get_pair_key(sid, partner_id), new_call_stats())
+    record_call_stats(pair_stats, sample)
+    record_call_stats(global_call_stats, sample)
+    if 'connection_type' in sample:
+        record_call_stats(call_stats_by_connection[sample['connection_type']], sample)
+
+# --- MODERATION ---
+
+def build_matcher(words):
+    """Builds an Aho-Corasick automaton as (goto, fail, output) tables."""
+    goto, fail, output = [{}], [0], [[]]
+    for word in words:
+        state = 0
+        for ch in word:
+            if ch not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                output.append([])
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        output[state].append(word)
+    # Breadth-first pass sets each state's fallback to its longest proper suffix in the trie
+    pending = deque(goto[0].values())
+    while pending:
+        state = pending.popleft()
+        for ch, nxt in goto[state].items():
+            pending.append(nxt)
+            fallback = fail[state]
+            while fallback and ch not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[nxt] = goto[fallback].get(ch, 0)
+            # A state also matches every word that ends at its fallback
+            output[nxt] = output[nxt] + output[fail[nxt]]
+    return goto, fail, output
+
+def is_word_char(ch):
+    return ch.isalnum() or ch == '_'
+
+def find_match(matcher, text):
+    """Returns the first whole-word match in text, or None. Single pass over the text."""
+    goto, fail, output = matcher
+    state = 0
+    for end, ch in enumerate(text):
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if not output[state]: continue
+        # Only accept hits bounded by non-word characters or the text edges
+        if end + 1 < len(text) and is_word_char(text[end + 1]): continue
+        for word in output[state]:
+            start = end - len(word) + 1
+            if start == 0 or not is_word_char(text[start - 1]): return word
+    return None
+
+def moderation_filter(func):
+    moderation_filters.append(func)
+    return func
+
+def get_client_key():
+    # ProxyFix has already replaced remote_addr with the hop our proxy appended; the
+    # client-controlled left-most X-Forwarded-For entries are never trusted
+    return request.remote_addr
+
+def is_muted(sid):
+    key = client_keys.get(sid)
+    expiry = muted_clients.get(key)
+    if not expiry: return False
+    if expiry > time.monotonic(): return True
+    del muted_clients[key]
+    return False
+
+def prune_reports(now):
+    # Reports are rare, so a full sweep here keeps both maps bounded by recent activity
+    for key in [k for k, expiry in muted_clients.items() if expiry <= now]:
+        del muted_clients[key]
+    for key, reporters in list(user_reports.items()):
+        for reporter in [r for r, expiry in reporters.items() if expiry <= now]:
+            del reporters[reporter]
+        if not reporters: del user_reports[key]
+
+@moderation_filter
+def check_length(sid, msg):
+    if len(msg) > MAX_MESSAGE_LENGTH: return 'too_long'
+
+if BLOCKED_WORDS:
+    blocked_words_matcher = build_matcher(BLOCKED_WORDS)
+
+    @moderation_filter
+    def check_blocked_words(sid, msg):
+        if find_match(blocked_words_matcher, msg.lower()): return 'blocked_word'
+
+if BLOCKED_PATTERNS:
+    blocked_pattern = re.compile('|'.join(f'(?:{p})' for p in BLOCKED_PATTERNS), re.IGNORECASE)
+
+    @moderation_filter
+    def check_blocked_patterns(sid, msg):
+        if blocked_pattern.search(msg): return 'blocked_pattern'
+
+def submit_for_moderation(sid, target, msg_id, msg):
+    global moderation_started
+    if not moderation_started:
+        moderation_started = True
+        for _ in range(MODERATION_WORKERS):
+            socketio.start_background_task(moderation_worker)
+    # Each async mode raises its own Full exception, so check the size up front
+    if moderation_queue.qsize() >= MODERATION_QUEUE_SIZE:
+        logger.warning(f"Moderation backlog full, message {msg_id} not checked")
+        return
+    moderation_queue.put_nowait((sid, target, msg_id, msg))
+
+def moderation_worker():
+    while True:
+        sid, target, msg_id, msg = moderation_queue.get()
+        try:
+            reason = next((r for r in (f(sid, msg) for f in moderation_filters) if r), None)
+        except Exception:
+            logger.exception(f"Moderation filter failed on message {msg_id}")
+            continue
+        if reason:
+            relay('message_retracted', {'id': msg_id}, target)
+            relay('message_blocked', {'reason': reason}, sid)
+            logger.info(f"Retracted message {msg_id} from {sid}: {reason}")
+
+@socketio.on('client_timing')
+def handle_client_timing(data):
+    name = data.get('name')
+    samples = client_timings.get(name)
+    ms = data.get('ms')
+    if samples is None or not isinstance(ms, (int, float)) or not 0 <= ms < 600000: return
+    now = time.monotonic()
+    last_reports = last_timing_reports.setdefault(request.sid, {})
+    if now - last_reports.get(name, 0) < TIMING_MIN_INTERVAL: return
+    last_reports[name] = now
+    samples.append(ms)
 
 if __name__ == '__main__':
     print("Starting Professional Video Chat Server on http://localhost:5000")